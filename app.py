@@ -1,17 +1,37 @@
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import collections
+import io
 import os
-import tempfile
 import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import time
+import uuid
 from dotenv import load_dotenv
 
 from yin_yang_processor import YinYangProcessor
+from utils import classify_path, read_data_file, reduce_mem_usage, write_excel
 
 # Load environment variables
 load_dotenv()
 
+# Maximum number of log messages kept for display
+MAX_LOG_MESSAGES = 500
+
+# Minimum number of seconds between progress updates
+PROGRESS_UPDATE_INTERVAL = 0.1
+
+# Display labels for each log message type
+LOG_LABELS = {
+    "yin": "🔵 Yin:",
+    "yang": "🟡 Yang:",
+    "system": "⚙️ System:",
+    "error": "❌ Error:",
+}
+
 # Page configuration
 st.set_page_config(
     page_title="Yin-Yang Row-wise Enrichment",
@@ -19,6 +39,42 @@ st.set_page_config(
     layout="wide",
 )
 
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """Thread pool for file I/O and processing, shared across script reruns."""
+    return ThreadPoolExecutor(max_workers=4)
+
+def load_data(uploaded_file) -> pd.DataFrame:
+    """Read the uploaded file and downcast its dtypes."""
+    return reduce_mem_usage(read_data_file(uploaded_file))
+
+# The cached views below are keyed by data_id, which identifies the processing
+# run; the DataFrame itself is passed unhashed (leading underscore).
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def preview_table(data_id: str, _df: pd.DataFrame) -> pa.Table:
+    """Arrow table of the first rows, shown as the data preview."""
+    return pa.Table.from_pandas(_df.head(5), preserve_index=False)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def csv_bytes(data_id: str, _df: pd.DataFrame) -> bytes:
+    """CSV download body."""
+    return _df.to_csv(index=False).encode("utf-8")
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def excel_bytes(data_id: str, _df: pd.DataFrame) -> bytes:
+    """Excel download body."""
+    buffer = io.BytesIO()
+    write_excel(_df, buffer)
+    return buffer.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def parquet_bytes(data_id: str, _df: pd.DataFrame) -> bytes:
+    """Parquet download body."""
+    buffer = io.BytesIO()
+    _df.to_parquet(buffer, index=False, compression="zstd")
+    return buffer.getvalue()
+
 def main():
     # Title and description
     st.title("☯️ Yin-Yang Row-wise LLM Enrichment")
@@ -50,13 +106,39 @@ def main():
                 ["gpt-4o", "gpt-3.5-turbo","gpt-4o-search-preview","gpt-4o-mini-search-preview"],
                 index=0,
             )
+        col3, col4 = st.columns(2)
+        with col3:
+            max_concurrency = st.number_input("Concurrent requests", min_value=1, max_value=64, value=8)
+        with col4:
+            requests_per_minute = st.number_input("Requests per minute", min_value=1, max_value=10000, value=500)
+        batch_size = st.number_input(
+            "Rows per request",
+            min_value=1,
+            max_value=50,
+            value=20,
+            help="Number of rows Yang enriches in a single LLM request.",
+        )
+        use_semantic_cache = st.checkbox(
+            "Reuse results for near-duplicate rows",
+            value=False,
+            help="Rows whose values are at least 95% similar to a previously enriched row reuse its result (single-row requests only).",
+        )
+        group_by_input_columns = st.checkbox(
+            "Share results between rows with the same relevant values",
+            value=False,
+            help="Yin picks the columns the command depends on; rows that agree on those columns are enriched once.",
+        )
     
     # Start button
-    start_button = st.button("Start Enrichment", type="primary", disabled=not (uploaded_file and user_command))
+    start_button = st.button(
+        "Start Enrichment",
+        type="primary",
+        disabled=not (uploaded_file and user_command) or st.session_state.get("process_future") is not None,
+    )
     
     # Initialize session state
     if "log_messages" not in st.session_state:
-        st.session_state.log_messages = []
+        st.session_state.log_messages = collections.deque(maxlen=MAX_LOG_MESSAGES)
     if "processed_data" not in st.session_state:
         st.session_state.processed_data = None
     if "is_processing" not in st.session_state:
@@ -65,6 +147,10 @@ def main():
         st.session_state.current_row = 0
     if "total_rows" not in st.session_state:
         st.session_state.total_rows = 0
+    if "last_progress_update" not in st.session_state:
+        st.session_state.last_progress_update = 0.0
+    if "process_future" not in st.session_state:
+        st.session_state.process_future = None
     
     # Create columns for log and progress
     log_col, progress_col = st.columns([2, 1])
@@ -72,17 +158,14 @@ def main():
     # Process data when the Start button is clicked
     if start_button:
         with st.spinner("Processing..."):
-            st.session_state.log_messages = []
+            st.session_state.log_messages = collections.deque(maxlen=MAX_LOG_MESSAGES)
             st.session_state.is_processing = True
             st.session_state.current_row = 0
             
-            # Read the uploaded file
-            if uploaded_file.name.endswith(('.xlsx', '.xls')):
-                df = pd.read_excel(uploaded_file)
-            else:
-                df = pd.read_csv(uploaded_file)
+            executor = get_executor()
             
-            st.session_state.total_rows = len(df)
+            # Read the uploaded file in the background while the processor is set up
+            load_future = executor.submit(load_data, uploaded_file)
             
             # Create output folder if it doesn't exist
             output_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output")
@@ -99,39 +182,47 @@ def main():
             output_filepath = os.path.join(output_folder, output_filename)
             st.session_state.output_filepath = output_filepath  # Store for later access
             
+            # The processor runs on a worker thread, so its callbacks only queue
+            # events; they are applied to the session state on this thread
+            events = queue.Queue()
+            
             # Initialize the YinYang processor with streaming output enabled
             processor = YinYangProcessor(
                 model_name=model_name,
                 max_retries=max_retries,
-                log_callback=add_log_message,
-                progress_callback=update_progress,
-                output_file=output_filepath  # Enable streaming output
+                log_callback=lambda message_type, content: events.put(("log", message_type, content)),
+                progress_callback=lambda current_row: events.put(("progress", current_row)),
+                output_file=output_filepath,  # Enable streaming output
+                max_concurrency=max_concurrency,
+                requests_per_minute=requests_per_minute,
+                semantic_cache_threshold=0.95 if use_semantic_cache else None,
+                batch_size=batch_size,
+                group_by_input_columns=group_by_input_columns,
             )
             
-            # Process the data
-            result_df = processor.process_data(df, user_command)
-            
-            # Save the processed data
-            st.session_state.processed_data = result_df
-            st.session_state.is_processing = False
+            df = load_future.result()
+            st.session_state.total_rows = len(df)
             
-            # Show success message
-            st.success(f"✅ Processing complete! Enriched {len(result_df)} rows. Data has been automatically saved to {output_filepath}")
+            # Process the data in the background; the future and its events are kept
+            # in the session so a rerun triggered mid-run resumes polling them
+            st.session_state.process_future = executor.submit(processor.process_data, df, user_command)
+            st.session_state.process_events = events
+    
+    # Show live progress until the background run finishes
+    if st.session_state.process_future is not None:
+        with st.spinner("Processing..."):
+            wait_for_processing()
     
     # Display log messages
     with log_col:
         st.subheader("Processing Log")
         log_container = st.container(height=400)
-        with log_container:
-            for msg in st.session_state.log_messages:
-                if msg.get("type") == "yin":
-                    st.markdown(f"**🔵 Yin:** {msg.get('content')}")
-                elif msg.get("type") == "yang":
-                    st.markdown(f"**🟡 Yang:** {msg.get('content')}")
-                elif msg.get("type") == "system":
-                    st.markdown(f"**⚙️ System:** {msg.get('content')}")
-                elif msg.get("type") == "error":
-                    st.markdown(f"**❌ Error:** {msg.get('content')}")
+        # Render the whole log as a single markdown element
+        log_container.markdown("\n\n".join(
+            f"**{LOG_LABELS[msg['type']]}** {msg['content']}"
+            for msg in st.session_state.log_messages
+            if msg.get("type") in LOG_LABELS
+        ))
     
     # Display progress
     with progress_col:
@@ -145,41 +236,58 @@ def main():
         if st.session_state.processed_data is not None and not st.session_state.is_processing:
             # Prepare the file for download
             if uploaded_file and uploaded_file.name:
-                filename, ext = os.path.splitext(uploaded_file.name)
-                if ext.lower() in ['.xlsx', '.xls']:
-                    # For Excel files, offer both Excel and CSV downloads
-                    col1, col2 = st.columns(2)
+                filename = os.path.splitext(uploaded_file.name)[0]
+                data_id = st.session_state.processed_data_id
+                processed_data = st.session_state.processed_data
+                
+                if classify_path(uploaded_file.name) in ('xlsx', 'xls'):
+                    # For Excel files, offer Excel, CSV and Parquet downloads
+                    col1, col2, col3 = st.columns(3)
                     
                     with col1:
-                        output_buffer = tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx')
-                        with pd.ExcelWriter(output_buffer.name) as writer:
-                            st.session_state.processed_data.to_excel(writer, index=False)
-                        
-                        with open(output_buffer.name, "rb") as f:
-                            st.download_button(
-                                label="📥 Download as Excel",
-                                data=f,
-                                file_name=f"{filename}_enriched.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            )
+                        st.download_button(
+                            label="📥 Download as Excel",
+                            data=excel_bytes(data_id, processed_data),
+                            file_name=f"{filename}_enriched.xlsx",
+                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        )
                     
                     with col2:
-                        csv_data = st.session_state.processed_data.to_csv(index=False)
+                        csv_data = csv_bytes(data_id, processed_data)
                         st.download_button(
                             label="📥 Download as CSV",
                             data=csv_data,
                             file_name=f"{filename}_enriched.csv",
                             mime="text/csv",
                         )
+                    
+                    with col3:
+                        st.download_button(
+                            label="📥 Download as Parquet",
+                            data=parquet_bytes(data_id, processed_data),
+                            file_name=f"{filename}_enriched.parquet",
+                            mime="application/vnd.apache.parquet",
+                        )
                 else:
-                    # For CSV files, just offer CSV download
-                    csv_data = st.session_state.processed_data.to_csv(index=False)
-                    st.download_button(
-                        label="📥 Download Enriched File",
-                        data=csv_data,
-                        file_name=f"{filename}_enriched.csv",
-                        mime="text/csv",
-                    )
+                    # For CSV files, offer CSV and Parquet downloads
+                    col1, col2 = st.columns(2)
+                    
+                    with col1:
+                        csv_data = csv_bytes(data_id, processed_data)
+                        st.download_button(
+                            label="📥 Download Enriched File",
+                            data=csv_data,
+                            file_name=f"{filename}_enriched.csv",
+                            mime="text/csv",
+                        )
+                    
+                    with col2:
+                        st.download_button(
+                            label="📥 Download as Parquet",
+                            data=parquet_bytes(data_id, processed_data),
+                            file_name=f"{filename}_enriched.parquet",
+                            mime="application/vnd.apache.parquet",
+                        )
                 
                 # Add note about auto-saved data
                 if hasattr(st.session_state, 'output_filepath') and os.path.exists(st.session_state.output_filepath):
@@ -187,7 +295,53 @@ def main():
             
             # Display data preview
             st.subheader("Data Preview")
-            st.dataframe(st.session_state.processed_data.head(5), use_container_width=True)
+            st.dataframe(preview_table(st.session_state.processed_data_id, st.session_state.processed_data), use_container_width=True)
+
+def wait_for_processing():
+    """
+    Poll the background run, showing its progress, and store its result once done.
+    
+    A widget interaction interrupts this with a rerun; the run keeps going
+    and the next script run resumes polling it from the session state.
+    """
+    process_future = st.session_state.process_future
+    events = st.session_state.process_events
+    
+    progress_placeholder = st.empty()
+    while not process_future.done():
+        apply_events(events)
+        progress_placeholder.progress(
+            st.session_state.current_row / max(1, st.session_state.total_rows),
+            text=f"Processing row {st.session_state.current_row} / {st.session_state.total_rows}",
+        )
+        time.sleep(PROGRESS_UPDATE_INTERVAL)
+    apply_events(events)
+    progress_placeholder.empty()
+    
+    # The run is over either way, so a failure does not leave the session stuck processing
+    st.session_state.process_future = None
+    st.session_state.is_processing = False
+    result_df = process_future.result()
+    
+    # Save the processed data; the cached views are shared by every session, so
+    # each run gets a random id rather than one derived from its file name
+    st.session_state.processed_data = result_df
+    st.session_state.processed_data_id = uuid.uuid4().hex
+    
+    # Show success message
+    st.success(f"✅ Processing complete! Enriched {len(result_df)} rows. Data has been automatically saved to {st.session_state.output_filepath}")
+
+def apply_events(events: queue.Queue):
+    """Apply log and progress events queued by the processor's callbacks."""
+    while True:
+        try:
+            event = events.get_nowait()
+        except queue.Empty:
+            return
+        if event[0] == "log":
+            add_log_message(event[1], event[2])
+        else:
+            update_progress(event[1])
 
 def add_log_message(message_type, content):
     """Add a message to the log."""
@@ -198,7 +352,12 @@ def add_log_message(message_type, content):
     })
 
 def update_progress(current_row):
-    """Update the progress state."""
+    """Update the progress state, at most every PROGRESS_UPDATE_INTERVAL seconds."""
+    now = time.monotonic()
+    is_last_row = current_row >= st.session_state.total_rows
+    if not is_last_row and now - st.session_state.last_progress_update < PROGRESS_UPDATE_INTERVAL:
+        return
+    st.session_state.last_progress_update = now
     st.session_state.current_row = current_row
 
 if __name__ == "__main__":
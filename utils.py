@@ -1,14 +1,152 @@
+import asyncio
+import atexit
+import functools
 import logging
+import logging.handlers
 import os
+import queue
+import threading
 import json
+import httpx
+import numpy as np
+import json_repair
+import openai
+import orjson
 import pandas as pd
-from typing import Dict, Any, Optional
+import pyarrow as pa
+import xlsxwriter
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from pathlib import PurePosixPath
+from typing import Dict, Any, Optional, BinaryIO, Literal, Union
 import sys
 
+# API errors worth retrying: rate limiting, timeouts, dropped connections and server errors
+TRANSIENT_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+# API errors that retrying the same request cannot fix
+NON_RETRIABLE_ERRORS = (
+    openai.BadRequestError,
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+    openai.NotFoundError,
+)
+
+class NonRetriableError(Exception):
+    """Raised by the agents when the API rejects a request in a way retrying cannot fix."""
+
+def transient_retry(attempts: int = 3) -> AsyncRetrying:
+    """
+    Build a retrying loop for a single API request.
+    
+    Only transient errors are retried, with exponential backoff plus jitter;
+    anything else is raised straight away.
+    
+    Args:
+        attempts: Maximum number of attempts, including the first
+        
+    Returns:
+        AsyncRetrying to iterate with ``async for attempt in ...: with attempt:``
+    """
+    return AsyncRetrying(
+        stop=stop_after_attempt(attempts),
+        wait=wait_exponential_jitter(initial=1, max=30),
+        retry=retry_if_exception_type(TRANSIENT_ERRORS),
+        reraise=True,
+    )
+
+# Shared AsyncOpenAI clients, one per event loop (an httpx connection pool
+# cannot be used from a loop other than the one it was created on)
+_CLIENTS: Dict[asyncio.AbstractEventLoop, openai.AsyncOpenAI] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def create_async_client() -> openai.AsyncOpenAI:
+    """
+    Create an AsyncOpenAI client with a tuned HTTP/2 connection pool.
+    
+    The pool must only be used on the event loop that first uses it, and the
+    caller is responsible for closing the client.
+    
+    Returns:
+        New AsyncOpenAI client
+    """
+    return openai.AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        # Retries are done by transient_retry, so they also respect the rate limits
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        ),
+    )
+
+def get_async_client() -> openai.AsyncOpenAI:
+    """
+    Return the process-wide AsyncOpenAI client for the running event loop.
+    
+    The client keeps a tuned HTTP/2 connection pool, so TCP and TLS
+    connections are reused across every request made on that loop.
+    
+    Returns:
+        Shared AsyncOpenAI client
+    """
+    loop = asyncio.get_running_loop()
+    with _CLIENTS_LOCK:
+        # Forget clients whose loop has finished
+        for closed_loop in [l for l in _CLIENTS if l.is_closed()]:
+            del _CLIENTS[closed_loop]
+        
+        if loop not in _CLIENTS:
+            _CLIENTS[loop] = create_async_client()
+        return _CLIENTS[loop]
+
+class AsyncClientMixin:
+    """
+    Gives an agent a ``client`` attribute that can be pointed at a run's client.
+    
+    Agents set ``self._client`` in ``__init__``; while it is None, requests
+    use the shared client for the running loop.
+    """
+    
+    _client: Optional[openai.AsyncOpenAI] = None
+    
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        """The AsyncOpenAI client used for requests."""
+        return self._client or get_async_client()
+    
+    @client.setter
+    def client(self, client: Optional[openai.AsyncOpenAI]):
+        # None goes back to the shared client for the running loop
+        self._client = client
+
+# Set once the logs directory has been created
+_LOGS_DIR_READY = False
+
+def _ensure_logs_dir():
+    """Create the logs directory the first time a logger needs it."""
+    global _LOGS_DIR_READY
+    if not _LOGS_DIR_READY:
+        os.makedirs('logs', exist_ok=True)
+        _LOGS_DIR_READY = True
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread."""
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The queue never leaves the process, so the record can be passed as is
+        # instead of being formatted (and stripped of its args) by the caller
+        return record
+
+@functools.lru_cache(maxsize=None)
 def get_logger(name: str) -> logging.Logger:
     """
     Create and configure a logger with the specified name.
     
+    Records are handed to a QueueHandler and written to the console and log
+    file by a QueueListener thread, so logging never blocks the caller on
+    file I/O. Loggers are memoized per name.
+    
     Args:
         name: Name of the logger
         
@@ -35,55 +173,169 @@ def get_logger(name: str) -> logging.Logger:
     # Add the formatter to the handler
     console_handler.setFormatter(formatter)
     
-    # Add the handler to the logger
-    logger.addHandler(console_handler)
-    
     # Create logs directory if it doesn't exist
-    os.makedirs('logs', exist_ok=True)
+    _ensure_logs_dir()
     
     # Create a file handler
     file_handler = logging.FileHandler(f'logs/{name.lower()}.log')
     file_handler.setLevel(logging.INFO)
     file_handler.setFormatter(formatter)
     
-    # Add the handler to the logger
-    logger.addHandler(file_handler)
+    # Route records through a queue so the sinks run on a listener thread
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, console_handler, file_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    
+    # Add the queue handler to the logger
+    logger.addHandler(_DeferredQueueHandler(log_queue))
     
     return logger
 
-def read_data_file(file_path: str) -> pd.DataFrame:
+# File types accepted as input data
+_ALLOWED = frozenset({"csv", "xlsx", "xls"})
+
+def classify_path(path: str) -> Optional[Literal["csv", "xlsx", "xls"]]:
+    """
+    Classify a file name by its extension.
+    
+    Args:
+        path: File name or path
+        
+    Returns:
+        The lower-case extension ('csv', 'xlsx' or 'xls'), or None if the
+        file type is not supported
+    """
+    suffix = PurePosixPath(path).suffix.lower().lstrip('.')
+    return suffix if suffix in _ALLOWED else None
+
+def read_data_file(file: Union[str, BinaryIO], file_name: Optional[str] = None) -> pd.DataFrame:
     """
     Read data from a CSV or Excel file.
     
+    The file is parsed straight from the path or file object (such as a
+    Streamlit upload) into Arrow-backed columns, which avoids the wide
+    NumPy/object intermediate copies of the default readers.
+    
     Args:
-        file_path: Path to the data file
+        file: Path to the data file, or a binary file object
+        file_name: Name used to determine the file type; defaults to the path
+            or the file object's name attribute
         
     Returns:
         Pandas DataFrame containing the data
     """
     # Check if the file exists
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File not found: {file_path}")
+    if isinstance(file, str) and not os.path.exists(file):
+        raise FileNotFoundError(f"File not found: {file}")
     
     # Determine the file type based on the extension
-    file_extension = os.path.splitext(file_path)[1].lower()
+    file_name = file_name or (file if isinstance(file, str) else getattr(file, "name", ""))
+    file_type = classify_path(file_name)
     
     # Read the file into a DataFrame
-    if file_extension in ['.xlsx', '.xls']:
-        return pd.read_excel(file_path)
-    elif file_extension == '.csv':
-        return pd.read_csv(file_path)
+    if file_type in ('xlsx', 'xls'):
+        return pd.read_excel(file, engine="calamine", dtype_backend="pyarrow")
+    elif file_type == 'csv':
+        return pd.read_csv(file, engine="pyarrow", dtype_backend="pyarrow")
     else:
-        raise ValueError(f"Unsupported file type: {file_extension}")
+        raise ValueError(f"Unsupported file type: {PurePosixPath(file_name).suffix}")
+
+def _smallest_dtype(series: pd.Series, candidates: list) -> Optional[np.dtype]:
+    """Return the first candidate dtype whose range holds every value of the series."""
+    column_min, column_max = series.min(), series.max()
+    for dtype in candidates:
+        info = np.iinfo(dtype) if np.issubdtype(dtype, np.integer) else np.finfo(dtype)
+        if info.min <= column_min and column_max <= info.max:
+            return np.dtype(dtype)
+    return None
+
+def reduce_mem_usage(df: pd.DataFrame, category_ratio: float = 0.5) -> pd.DataFrame:
+    """
+    Downcast column dtypes to the smallest type that holds the data.
+    
+    Integer columns are narrowed to the smallest width covering their range,
+    float columns to float32 only when that is lossless, and string columns
+    with few distinct values become categoricals. Arrow-backed columns stay
+    Arrow-backed.
+    
+    Args:
+        df: DataFrame to downcast
+        category_ratio: Maximum ratio of unique values to rows for a string
+            column to be converted to a category
+        
+    Returns:
+        DataFrame with downcast column dtypes
+    """
+    # Columns are only reassigned, never modified in place, so the input's data can be shared
+    df = df.copy(deep=False)
+    
+    for column in df.columns:
+        series = df[column]
+        values = series.dropna()
+        if values.empty:
+            continue
+        
+        is_arrow = isinstance(series.dtype, pd.ArrowDtype)
+        new_dtype = None
+        
+        if pd.api.types.is_bool_dtype(series.dtype):
+            continue
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            new_dtype = _smallest_dtype(values, [np.int8, np.int16, np.int32])
+        elif pd.api.types.is_float_dtype(series.dtype):
+            # Only narrow floats when no precision is lost
+            if (values.astype(np.float32).astype(np.float64) == values.astype(np.float64)).all():
+                new_dtype = _smallest_dtype(values, [np.float32])
+        elif pd.api.types.is_string_dtype(series.dtype) or series.dtype == object:
+            if values.nunique() / len(series) < category_ratio:
+                df[column] = series.astype("category")
+            continue
+        
+        if new_dtype is not None and new_dtype != series.dtype:
+            if is_arrow:
+                df[column] = series.astype(pd.ArrowDtype(pa.from_numpy_dtype(new_dtype)))
+            else:
+                df[column] = series.astype(new_dtype)
+    
+    return df
+
+def write_excel(df: pd.DataFrame, target: Union[str, BinaryIO]):
+    """
+    Write a DataFrame to an .xlsx file using xlsxwriter in constant_memory mode.
+    
+    constant_memory flushes each row to disk as soon as the next one starts,
+    so rows must be written strictly in order. pandas' own Excel writer emits
+    cells column by column, which is why the rows are written here directly.
+    
+    Args:
+        df: DataFrame to save
+        target: Path or binary file object to write the workbook to
+    """
+    workbook = xlsxwriter.Workbook(target, {
+        "constant_memory": True,
+        "default_date_format": "yyyy-mm-dd",
+    })
+    try:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, [str(column) for column in df.columns])
+        
+        for row_number, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            # Missing values become empty cells
+            worksheet.write_row(row_number, 0, [None if pd.isna(value) else value for value in row])
+    finally:
+        workbook.close()
 
 def save_data_file(df: pd.DataFrame, output_path: str, file_format: str = None):
     """
-    Save a DataFrame to a CSV or Excel file.
+    Save a DataFrame to a CSV, Excel or Parquet file.
     
     Args:
         df: DataFrame to save
         output_path: Path to save the file
-        file_format: Optional format override ('csv' or 'excel')
+        file_format: Optional format override ('csv', 'excel' or 'parquet')
     """
     # Create output directory if it doesn't exist
     output_dir = os.path.dirname(output_path)
@@ -93,18 +345,18 @@ def save_data_file(df: pd.DataFrame, output_path: str, file_format: str = None):
     # Determine the file format based on the extension or the specified format
     if file_format:
         file_format = file_format.lower()
+    elif classify_path(output_path) in ('xlsx', 'xls'):
+        file_format = 'excel'
+    elif PurePosixPath(output_path).suffix.lower() == '.parquet':
+        file_format = 'parquet'
     else:
-        file_extension = os.path.splitext(output_path)[1].lower()
-        if file_extension in ['.xlsx', '.xls']:
-            file_format = 'excel'
-        elif file_extension == '.csv':
-            file_format = 'csv'
-        else:
-            file_format = 'csv'  # Default to CSV
+        file_format = 'csv'  # Default to CSV
     
     # Save the DataFrame
     if file_format == 'excel':
-        df.to_excel(output_path, index=False)
+        write_excel(df, output_path)
+    elif file_format == 'parquet':
+        df.to_parquet(output_path, index=False, compression="zstd")
     else:
         df.to_csv(output_path, index=False)
 
@@ -119,18 +371,11 @@ def parse_json_safely(json_str: str) -> Optional[Dict[str, Any]]:
         Parsed JSON object or None if parsing fails
     """
     try:
-        return json.loads(json_str)
+        return orjson.loads(json_str)
     except json.JSONDecodeError:
-        # Try to extract JSON from a string that might contain other text
+        # Recover JSON from a string that might contain other text or be truncated
         try:
-            # Look for JSON-like patterns
-            start_idx = json_str.find("{")
-            end_idx = json_str.rfind("}")
-            
-            if start_idx >= 0 and end_idx > start_idx:
-                json_content = json_str[start_idx:end_idx + 1]
-                return json.loads(json_content)
-            
-            return None
+            result = json_repair.loads(json_str)
+            return result if isinstance(result, dict) and result else None
         except Exception:
             return None
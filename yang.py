@@ -1,15 +1,255 @@
+import asyncio
 import json
 import os
-from typing import Dict, Any, List, Optional
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Any, List, Optional
+import numpy as np
+import json_repair
 import openai
+import orjson
+import pandas as pd
+import xxhash
 from dotenv import load_dotenv
 
-from utils import get_logger
+from utils import NON_RETRIABLE_ERRORS, AsyncClientMixin, NonRetriableError, get_logger, transient_retry
 
 # Load environment variables
 load_dotenv()
 
-class YangAgent:
+# Location of the persisted response cache
+CACHE_PATH = os.path.join("logs", "yang_cache.parquet")
+
+# Embedding model used by the semantic cache tier
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Rows of the embedding matrix upcast to float32 at a time when searching
+SEARCH_BLOCK_ROWS = 4096
+
+# Serializes cache saves within the process (Streamlit runs each session in a thread),
+# so concurrent sessions merge their entries instead of overwriting each other's
+_SAVE_LOCK = threading.Lock()
+
+class SemanticCache:
+    """
+    Two-tier cache of Yang's results, persisted to a parquet file.
+    
+    The first tier maps an exact payload hash to its result. The second keeps
+    one unit embedding per result and returns the closest entry when its
+    cosine similarity reaches the threshold. Semantic entries carry a scope
+    key and are only matched within their scope, since the embedded text need
+    not hold everything the result depends on. Embeddings are stored as float16,
+    which halves their memory for a negligible loss in cosine, in a buffer
+    that grows by doubling so adding an entry does not copy the whole matrix.
+    Searches upcast one block of rows at a time, and the file keeps the raw
+    float16 bytes.
+    
+    At most ``maxsize`` results are kept, evicting the least recently used.
+    """
+    
+    def __init__(self, path: str, threshold: Optional[float] = None, maxsize: int = 100_000):
+        """
+        Initialize an empty cache.
+        
+        Args:
+            path: Parquet file the cache is loaded from and saved to
+            threshold: Cosine similarity above which search returns a result
+                (None disables the semantic tier)
+            maxsize: Maximum number of results kept
+        """
+        self.path = path
+        self.threshold = threshold
+        self.maxsize = max(1, maxsize)
+        self.logger = get_logger("SemanticCache")
+        # Results in least to most recently used order
+        self._results: Dict[int, Dict[str, Any]] = {}
+        # Semantic tier: buffer rows in insertion order, with the row of each
+        # live key; rows of evicted keys are marked dead until the next compaction
+        self._semantic_keys: List[int] = []
+        self._positions: Dict[int, int] = {}
+        self._embeddings = np.empty((0, 0), dtype=np.float16)
+        self._scopes = np.empty(0, dtype=np.uint64)
+        self._live = np.empty(0, dtype=bool)
+    
+    def __len__(self) -> int:
+        return len(self._results)
+    
+    def get(self, key: int) -> Optional[Dict[str, Any]]:
+        """Return a copy of the result stored under the exact key, if any."""
+        result = self._results.pop(key, None)
+        if result is None:
+            return None
+        self._results[key] = result
+        return dict(result)
+    
+    def search(self, embedding: np.ndarray, scope: int) -> Optional[Dict[str, Any]]:
+        """Return a copy of the result in the scope most similar to the embedding, if above the threshold."""
+        count = len(self._semantic_keys)
+        if self.threshold is None or not count or self._embeddings.shape[1] != embedding.shape[0]:
+            return None
+        
+        # Score in blocks so only one block at a time is upcast to float32
+        embedding = embedding.astype(np.float32, copy=False)
+        best, best_similarity = None, -np.inf
+        for start in range(0, count, SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, count)
+            in_scope = self._live[start:stop] & (self._scopes[start:stop] == np.uint64(scope))
+            if not in_scope.any():
+                continue
+            similarities = self._embeddings[start:stop].astype(np.float32) @ embedding
+            similarities[~in_scope] = -np.inf
+            position = int(np.argmax(similarities))
+            if similarities[position] > best_similarity:
+                best, best_similarity = start + position, similarities[position]
+        
+        if best is not None and best_similarity >= self.threshold:
+            return self.get(self._semantic_keys[best])
+        return None
+    
+    def put(
+        self,
+        key: int,
+        result: Dict[str, Any],
+        embedding: Optional[np.ndarray] = None,
+        scope: Optional[int] = None,
+    ):
+        """Store a successful result in the exact tier and, with an embedding and scope, the semantic tier."""
+        if not isinstance(result, dict):
+            return
+        self._results.pop(key, None)
+        self._results[key] = result
+        while len(self._results) > self.maxsize:
+            self._evict(next(iter(self._results)))
+        if embedding is None or scope is None or key in self._positions:
+            return
+        
+        count = len(self._semantic_keys)
+        if not count:
+            self._resize(16, embedding.shape[0])
+        elif self._embeddings.shape[1] != embedding.shape[0]:
+            return
+        elif count == len(self._embeddings):
+            self._resize(2 * count, embedding.shape[0])
+        
+        self._embeddings[count] = embedding
+        self._scopes[count] = scope
+        self._live[count] = True
+        self._semantic_keys.append(key)
+        self._positions[key] = count
+    
+    def _evict(self, key: int):
+        """Drop a result, compacting the semantic tier once half of its rows are dead."""
+        del self._results[key]
+        position = self._positions.pop(key, None)
+        if position is None:
+            return
+        
+        self._live[position] = False
+        if len(self._positions) < len(self._semantic_keys) // 2:
+            keep = np.flatnonzero(self._live[:len(self._semantic_keys)])
+            self._embeddings = self._embeddings[keep]
+            self._scopes = self._scopes[keep]
+            self._live = self._live[keep]
+            self._semantic_keys = [self._semantic_keys[i] for i in keep]
+            self._positions = {key: i for i, key in enumerate(self._semantic_keys)}
+    
+    def _resize(self, capacity: int, dimensions: int):
+        """Reallocate the semantic tier's buffers, keeping the rows in use."""
+        count = len(self._semantic_keys)
+        embeddings = np.empty((capacity, dimensions), dtype=np.float16)
+        scopes = np.empty(capacity, dtype=np.uint64)
+        live = np.zeros(capacity, dtype=bool)
+        if count:
+            embeddings[:count] = self._embeddings[:count]
+            scopes[:count] = self._scopes[:count]
+            live[:count] = self._live[:count]
+        self._embeddings, self._scopes, self._live = embeddings, scopes, live
+    
+    def load(self):
+        """Load the entries persisted by a previous run, if any."""
+        if not os.path.exists(self.path):
+            return
+        
+        try:
+            cache_df = pd.read_parquet(self.path)
+            # Files written before scopes existed keep only their exact entries
+            scopes = cache_df["scope"] if "scope" in cache_df else [None] * len(cache_df)
+            for key, result, embedding, scope in zip(cache_df["key"], cache_df["result"], cache_df["embedding"], scopes):
+                has_scope = embedding is not None and not pd.isna(scope)
+                if has_scope:
+                    # Embeddings are stored as raw float16 bytes; older files hold lists of floats
+                    if isinstance(embedding, bytes):
+                        embedding = np.frombuffer(embedding, dtype=np.float16)
+                    else:
+                        embedding = np.asarray(embedding, dtype=np.float16)
+                self.put(
+                    int(key),
+                    orjson.loads(result),
+                    embedding if has_scope else None,
+                    int(scope) if has_scope else None,
+                )
+            self.logger.info(f"Loaded {len(self)} cached responses from {self.path}")
+        except Exception as e:
+            self.logger.error(f"Error loading response cache: {str(e)}")
+    
+    def save(self):
+        """
+        Persist both tiers so they can be reused by later runs.
+        
+        Entries saved to the file by other sessions since it was loaded are
+        kept, and the file is replaced atomically so an interrupted write
+        never leaves it corrupt.
+        """
+        if not self._results:
+            return
+        
+        try:
+            with _SAVE_LOCK:
+                self._merge_and_write()
+        except Exception as e:
+            self.logger.error(f"Error saving response cache: {str(e)}")
+    
+    def _merge_and_write(self):
+        """Write this cache merged into the file's current contents, replacing the file atomically."""
+        # Merge into the current file contents, with this cache's entries as the most recent
+        merged = SemanticCache(self.path, self.threshold, self.maxsize)
+        merged.load()
+        for key, result in self._results.items():
+            position = self._positions.get(key)
+            merged.put(
+                key,
+                result,
+                self._embeddings[position] if position is not None else None,
+                int(self._scopes[position]) if position is not None else None,
+            )
+        
+        cache_df = pd.DataFrame({
+            "key": pd.array(list(merged._results), dtype="uint64"),
+            "result": [orjson.dumps(result).decode() for result in merged._results.values()],
+            "embedding": [
+                merged._embeddings[merged._positions[key]].tobytes() if key in merged._positions else None
+                for key in merged._results
+            ],
+            "scope": pd.array(
+                [int(merged._scopes[merged._positions[key]]) if key in merged._positions else None for key in merged._results],
+                dtype="UInt64",
+            ),
+        })
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            cache_df.to_parquet(temp_path, index=False)
+            os.replace(temp_path, self.path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+class YangAgent(AsyncClientMixin):
     """
     Yang Agent: The executor and retriever component of the Yin-Yang architecture.
     Responsible for:
@@ -19,73 +259,249 @@ class YangAgent:
     4. Returning structured enrichment results in JSON format
     """
     
-    def __init__(self, model_name: str = "gpt-4"):
+    def __init__(
+        self,
+        model_name: str = "gpt-4",
+        rpm: int = 500,
+        concurrency: int = 8,
+        semantic_threshold: Optional[float] = None,
+        client: Optional[openai.AsyncOpenAI] = None,
+    ):
         """
         Initialize the Yang Agent.
         
         Args:
             model_name: The OpenAI model to use
+            rpm: Maximum number of requests sent to the API per rolling 60 seconds
+            concurrency: Maximum number of requests in flight at once
+            semantic_threshold: Cosine similarity above which a cached result is reused
+                for a near-duplicate task (None disables the semantic cache tier)
+            client: AsyncOpenAI client to use; defaults to the shared client for the running loop
         """
         self.model_name = model_name
+        self.rpm = rpm
+        self.concurrency = concurrency
+        self.semantic_threshold = semantic_threshold
         self.logger = get_logger("YangAgent")
         self.api_key = os.getenv("OPENAI_API_KEY")
         
         if not self.api_key:
             raise ValueError("OpenAI API key not found. Please set the OPENAI_API_KEY environment variable.")
         
-        self.client = openai.OpenAI(api_key=self.api_key)
+        self._client = client
+        
+        # Rolling window of request timestamps; the asyncio primitives are
+        # created lazily so they bind to the event loop that is actually running
+        self._request_times = deque()
+        self._rate_lock = None
+        self._semaphore = None
+        self._limits_loop = None
+        
+        # Two-tier response cache: exact payload hash, then embedding similarity
+        self.cache = SemanticCache(CACHE_PATH, semantic_threshold)
+        self.cache.load()
+        
+        # System prompt seen on the first request; it should never change within a run
+        self._system_prompt: Optional[str] = None
+        
+        # Prompt tokens sent and tokens served from the provider's prefix cache
+        self._prompt_tokens = 0
+        self._cached_tokens = 0
+    
+    def _check_system_prompt(self, messages: List[Dict[str, Any]]):
+        """Warn if the system prompt differs from earlier requests, which defeats prompt caching."""
+        if not messages or messages[0].get("role") != "system":
+            return
+        
+        content = messages[0].get("content")
+        if self._system_prompt is None:
+            self._system_prompt = content
+        elif content != self._system_prompt:
+            self.logger.warning("System prompt changed between requests; provider prompt caching will miss")
+            self._system_prompt = content
+    
+    def _log_prompt_cache(self, usage: Any):
+        """Log how much of the prompt the provider served from its prefix cache."""
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or 0
+        prompt = getattr(usage, "prompt_tokens", None) or 0
+        if not prompt:
+            return
+        
+        self._prompt_tokens += prompt
+        self._cached_tokens += cached
+        self.logger.info(
+            f"Prompt cache: {cached}/{prompt} tokens cached "
+            f"({self._cached_tokens / self._prompt_tokens:.0%} this run)"
+        )
+    
+    def save_cache(self):
+        """Persist the response cache so it can be reused by later runs."""
+        self.cache.save()
+    
+    def _cache_key(self, messages: List[Dict[str, Any]]) -> int:
+        """Hash the model name and message payload into an exact-match cache key."""
+        # Feed the fields straight into the hash instead of building a canonical JSON string
+        h = xxhash.xxh3_64(self.model_name.encode())
+        for message in messages:
+            h.update(b"\x01")
+            h.update(message["role"].encode())
+            h.update(b"\0")
+            h.update(message["content"].encode())
+        return h.intdigest()
+    
+    def _scope_key(self, messages: List[Dict[str, Any]]) -> int:
+        """Hash the model name and system messages, which the semantic tier does not embed."""
+        h = xxhash.xxh3_64(self.model_name.encode())
+        for message in messages:
+            if message.get("role") != "user":
+                h.update(b"\x01")
+                h.update(message["content"].encode())
+        return h.intdigest()
+    
+    async def _embed(self, text: str) -> np.ndarray:
+        """Embed the text as a unit vector."""
+        async with self._semaphore:
+            response = await self.client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
     
-    def process_task(self, task: Dict[str, Any]) -> Dict[str, Any]:
+    def _ensure_limits(self):
+        """Create the rate-limiting primitives for the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._limits_loop is not loop:
+            self._rate_lock = asyncio.Lock()
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._limits_loop = loop
+    
+    async def _wait_for_rate_slot(self):
+        """Wait until a request can be sent without exceeding the rpm budget."""
+        async with self._rate_lock:
+            while True:
+                now = time.monotonic()
+                # Drop timestamps that have left the 60 second window
+                while self._request_times and now - self._request_times[0] >= 60:
+                    self._request_times.popleft()
+                
+                if len(self._request_times) < self.rpm:
+                    self._request_times.append(now)
+                    return
+                
+                # Sleep until the oldest request leaves the window
+                await asyncio.sleep(self._request_times[0] + 60 - now)
+    
+    @asynccontextmanager
+    async def request_slot(self) -> AsyncIterator[None]:
         """
-        Process a task received from Yin.
+        Hold one of the concurrency slots and one request of the rpm budget.
+        
+        Other agents calling the same API can use this so their requests
+        count against the same limits as Yang's.
+        """
+        self._ensure_limits()
+        async with self._semaphore:
+            await self._wait_for_rate_slot()
+            yield
+    
+    async def process_task_async(self, task: Dict[str, Any], use_cache: bool = True) -> Dict[str, Any]:
+        """
+        Process a task received from Yin without blocking the event loop.
         
         Args:
             task: Dictionary containing the task details
+            use_cache: Whether a cached result may be returned instead of calling the LLM.
+                Successful results are stored in the cache either way.
             
         Returns:
             JSON-serializable dictionary with enrichment results
+            
+        Raises:
+            NonRetriableError: If the API rejects the request (bad request, authentication
+                or permission errors), since sending it again cannot succeed
         """
         try:
-            # Extract the messages from the task
+            # Extract the messages and the optional structured output format from the task
             messages = task.get("messages", [])
+            response_format = task.get("response_format")
+            max_tokens = task.get("max_tokens", 1000)
+            self._check_system_prompt(messages)
             
-            # Create a chat completion request with the messages
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                # tools=[
-                #     {
-                #     "type": "web_search_preview",
-                #     "user_location": {
-                #         "type": "approximate",
-                #         "country": "US"
-                #     },
-                #     "search_context_size": "low"
-                #     }
-                # ],
-                messages=messages,
-                max_tokens=1000,
-                # temperature=0.7,
-                # response_format={"type": "json_object"}
-            )
+            self._ensure_limits()
+            
+            # Check the exact-match tier, then the semantic tier
+            key = self._cache_key(messages)
+            scope = self._scope_key(messages)
+            embedding = None
+            cached = self.cache.get(key) if use_cache else None
+            if cached is not None:
+                self.logger.info("Returning cached result for identical task")
+                return cached
+            
+            # Only tasks that name their row data use the semantic tier; the shared
+            # instruction text would make unrelated rows look alike, and a near-duplicate
+            # batch says nothing about which of its results belongs to which row
+            semantic_text = task.get("semantic_text")
+            if self.semantic_threshold is not None and semantic_text:
+                embedding = await self._embed(semantic_text)
+                cached = self.cache.search(embedding, scope) if use_cache else None
+                if cached is not None:
+                    self.logger.info("Returning cached result for near-duplicate task")
+                    return cached
+            
+            # Create a chat completion request with the messages, respecting the rate limits
+            # (each retry of a transient error waits for a fresh slot)
+            async for attempt in transient_retry():
+                with attempt:
+                    async with self.request_slot():
+                        response = await self.client.chat.completions.create(
+                            model=self.model_name,
+                            # tools=[
+                            #     {
+                            #     "type": "web_search_preview",
+                            #     "user_location": {
+                            #         "type": "approximate",
+                            #         "country": "US"
+                            #     },
+                            #     "search_context_size": "low"
+                            #     }
+                            # ],
+                            messages=messages,
+                            max_tokens=max_tokens,
+                            # temperature=0.7,
+                            **({"response_format": response_format} if response_format else {}),
+                        )
             
             # Extract the content from the response
-            content = response.choices[0].message.content
+            choice = response.choices[0]
+            content = choice.message.content
+            self._log_prompt_cache(getattr(response, "usage", None))
             
-            # Parse the JSON response
+            # Output cut off at max_tokens can still repair into plausible JSON with
+            # its last value truncated, so it is neither parsed nor cached
+            if getattr(choice, "finish_reason", None) == "length":
+                self.logger.warning(f"Response truncated at {max_tokens} tokens")
+                return {"error": f"Response truncated at {max_tokens} tokens", "finish_reason": "length"}
+            
+            # Parse the JSON response (orjson.JSONDecodeError subclasses json.JSONDecodeError)
             try:
-                result = json.loads(content)
+                result = orjson.loads(content)
                 self.logger.info(f"Successfully processed task and generated JSON result")
+                self.cache.put(key, result, embedding, scope)
                 return result
             except json.JSONDecodeError as e:
                 self.logger.error(f"Failed to parse JSON response: {str(e)}")
-                # If parsing fails, attempt to extract JSON from the response using string manipulation
+                # If parsing fails, attempt to recover the JSON object from the response
                 extracted_json = self._extract_json(content)
                 if extracted_json:
+                    self.cache.put(key, extracted_json, embedding, scope)
                     return extracted_json
                 
                 # If extraction fails, return a simple error object
                 return {"error": "Failed to generate valid JSON response"}
         
+        except NON_RETRIABLE_ERRORS as e:
+            self.logger.error(f"Request rejected by the API: {str(e)}")
+            raise NonRetriableError(str(e)) from e
         except Exception as e:
             self.logger.error(f"Error processing task: {str(e)}")
             return {"error": f"Processing error: {str(e)}"}
@@ -94,6 +510,9 @@ class YangAgent:
         """
         Attempt to extract a JSON object from a string that might contain additional text.
         
+        json_repair tolerates surrounding prose, code fences and truncated
+        output, which saves a retry (and another LLM call) in those cases.
+        
         Args:
             content: String that might contain a JSON object
             
@@ -101,13 +520,9 @@ class YangAgent:
             Extracted JSON object or None if extraction fails
         """
         try:
-            # Look for JSON-like patterns in the content
-            start_idx = content.find("{")
-            end_idx = content.rfind("}")
-            
-            if start_idx >= 0 and end_idx > start_idx:
-                json_str = content[start_idx:end_idx + 1]
-                return json.loads(json_str)
+            result = json_repair.loads(content)
+            if isinstance(result, dict) and result:
+                return result
             
             return None
         except Exception as e:
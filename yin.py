@@ -1,16 +1,63 @@
-import json
 import os
+import re
 import requests
-from typing import Dict, Tuple, Any, List, Optional
+from contextlib import nullcontext
+from typing import AsyncContextManager, Callable, Dict, Tuple, Any, List, Optional
+import fastjsonschema
 import openai
+import orjson
+import pandas as pd
 from dotenv import load_dotenv
+from pydantic import ConfigDict, Field, create_model
 
-from utils import get_logger
+from utils import NON_RETRIABLE_ERRORS, AsyncClientMixin, NonRetriableError, get_logger, parse_json_safely, transient_retry
 
 # Load environment variables
 load_dotenv()
 
-class YinAgent:
+# Models that accept response_format={"type": "json_schema", ...}
+STRUCTURED_OUTPUT_MODELS = {"gpt-4o", "gpt-4o-mini"}
+
+# Output token budget of a Yang request: 1000 for a single row, growing with
+# the batch size up to what the model can generate in one response
+YANG_TOKENS_PER_ROW = 500
+YANG_MIN_TOKENS = 1000
+MAX_OUTPUT_TOKENS = {"gpt-4o": 16384, "gpt-4o-mini": 16384}
+DEFAULT_MAX_OUTPUT_TOKENS = 4096
+
+# System message that explains Yang's role. YinAgent appends the enrichment
+# command and the planned attribute names to it once per run, and the result
+# is kept byte-identical for every task so the provider's prompt-prefix cache
+# can be reused across rows.
+YANG_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": (
+        "You are Yang, an AI assistant specialized in data enrichment. "
+        "Your task is to analyze data and provide enrichment attributes. "
+        "You should return ONLY a JSON object with your enrichment results. "
+        "Each key in the JSON object should be an attribute, and each value should be the enrichment value in string data type."
+        "Only include your explanations and evidence weblink in evidence field when requested, to keep other fields clean "
+    )
+}
+
+# Verdict the validator is asked to lead its answer with
+VERDICT_PATTERN = re.compile(r"WOO?HOO|NAYNAY", re.IGNORECASE)
+
+def _json_default(value: Any) -> Any:
+    """Serialize values json cannot handle natively, mapping missing values to null."""
+    if pd.isna(value):
+        return None
+    return str(value)
+
+def _dump_row(value: Any) -> str:
+    """Serialize row data as compact JSON with sorted keys, so equal rows give identical bytes."""
+    return orjson.dumps(
+        value,
+        default=_json_default,
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+    ).decode()
+
+class YinAgent(AsyncClientMixin):
     """
     Yin Agent: The planner and validator component of the Yin-Yang architecture.
     Responsible for:
@@ -22,33 +69,173 @@ class YinAgent:
     6. Managing the enrichment process
     """
     
-    def __init__(self, model_name: str = "gpt-4"):
+    def __init__(
+        self,
+        model_name: str = "gpt-4",
+        client: Optional[openai.AsyncOpenAI] = None,
+        request_slot: Optional[Callable[[], AsyncContextManager]] = None,
+        validation_reasoning: bool = False,
+    ):
         """
         Initialize the Yin Agent.
         
         Args:
             model_name: The OpenAI model to use
+            client: AsyncOpenAI client to use; defaults to the shared client for the running loop
+            request_slot: Returns an async context manager held around each API request,
+                used to share rate limits with other agents (no limiting if None)
+            validation_reasoning: Whether to read the validator's full reasoning; when False
+                the response stream is closed as soon as the verdict appears
         """
         self.model_name = model_name
         self.logger = get_logger("YinAgent")
         self.user_command = None
+        self.output_attributes: List[str] = []
+        self.input_columns: List[str] = []
+        self.output_schema: Optional[Dict[str, Any]] = None
+        self.yang_system_message: Dict[str, str] = YANG_SYSTEM_MESSAGE
+        self._check_structure: Optional[Callable[[Dict[str, Any]], Any]] = None
         self.api_key = os.getenv("OPENAI_API_KEY")
         
         if not self.api_key:
             raise ValueError("OpenAI API key not found. Please set the OPENAI_API_KEY environment variable.")
         
-        self.client = openai.OpenAI(api_key=self.api_key)
+        self._client = client
+        self._request_slot = request_slot or nullcontext
+        self.validation_reasoning = validation_reasoning
     
-    def initialize_with_command(self, user_command: str):
+    async def initialize_with_command(self, user_command: str, columns: Optional[List[str]] = None):
         """
         Initialize the agent with a user command.
         
         Args:
             user_command: Natural language command from the user
+            columns: Column names of the data to enrich, used to plan which columns
+                the enrichment depends on
         """
         self.user_command = user_command
+        self.output_attributes, self.input_columns = await self._plan_output(user_command, columns or [])
+        
+        # The command is the same for every row, so it belongs in the shared system prefix.
+        # The planned attribute names are spelled out too, since only some models
+        # receive them through the structured output schema
+        system_content = f"{YANG_SYSTEM_MESSAGE['content']}\n\nENRICHMENT TASK:\n{user_command}"
+        if self.output_attributes:
+            system_content += f"\n\nOUTPUT ATTRIBUTES (use these exact keys):\n{_dump_row(self.output_attributes)}"
+        self.yang_system_message = {"role": "system", "content": system_content}
+        self.output_schema = self._build_output_schema(self.output_attributes)
+        self._check_structure = self._compile_structure_check(self.output_attributes)
         self.logger.info(f"Initialized with command: {user_command}")
     
+    async def _plan_output(self, user_command: str, columns: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        Ask the LLM once which attributes the enrichment command should produce
+        and which input columns their values depend on.
+        
+        Args:
+            user_command: Natural language command from the user
+            columns: Column names of the data to enrich
+            
+        Returns:
+            Tuple of (attribute names, input column names). Either list is empty
+            if planning failed; input columns are restricted to known columns.
+        """
+        system_message = {
+            "role": "system",
+            "content": (
+                "You are an output planner for a data enrichment system. "
+                "Given an enrichment command, list the attribute names that should be added to each data row. "
+                "Include an 'evidence' attribute only if the command asks for explanations, evidence or sources. "
+                "Also list the input columns whose values the new attributes depend on; "
+                "rows that agree on those columns will share one enrichment. "
+                'Return ONLY a JSON object of the form {"attributes": ["attribute_name", ...], '
+                '"input_columns": ["column_name", ...]}.'
+            )
+        }
+        user_message = {
+            "role": "user",
+            "content": f"ENRICHMENT COMMAND:\n{user_command}\n\nCOLUMNS:\n{_dump_row(columns)}"
+        }
+        
+        try:
+            async for attempt in transient_retry():
+                with attempt:
+                    async with self._request_slot():
+                        response = await self.client.chat.completions.create(
+                            model=self.model_name,
+                            messages=[system_message, user_message],
+                            max_tokens=300,
+                        )
+            plan = parse_json_safely(response.choices[0].message.content) or {}
+            attributes = plan.get("attributes", [])
+            input_columns = plan.get("input_columns", [])
+            
+            # Keep unique, non-empty string names in their original order
+            attributes = list(dict.fromkeys(
+                name.strip() for name in attributes if isinstance(name, str) and name.strip()
+            ))
+            # Column names must match exactly; an unknown name disables grouping
+            # rather than silently grouping on too few columns
+            if not isinstance(input_columns, list) or any(name not in columns for name in input_columns):
+                input_columns = []
+            return attributes, list(dict.fromkeys(input_columns))
+        except Exception as e:
+            self.logger.error(f"Error planning output attributes: {str(e)}")
+            return [], []
+    
+    def _build_output_schema(self, attributes: List[str]) -> Optional[Dict[str, Any]]:
+        """
+        Build the strict JSON schema for Yang's output from the planned attributes.
+        
+        Args:
+            attributes: Attribute names Yang should return
+            
+        Returns:
+            JSON schema with one required string property per attribute, or None
+            if there are no attributes or the model does not support structured outputs
+        """
+        if not attributes or self.model_name not in STRUCTURED_OUTPUT_MODELS:
+            return None
+        
+        # Attribute names are exposed through aliases since they need not be identifiers
+        fields = {
+            f"attribute_{i}": (str, Field(alias=name))
+            for i, name in enumerate(attributes)
+        }
+        model = create_model("Enrichment", __config__=ConfigDict(extra="forbid"), **fields)
+        return model.model_json_schema(by_alias=True)
+    
+    def _compile_structure_check(self, attributes: List[str]) -> Optional[Callable[[Dict[str, Any]], Any]]:
+        """
+        Compile a validator that checks Yang's response carries every planned attribute.
+        
+        Unlike the structured output schema this is used with every model, and it
+        lets responses that are malformed be rejected without asking the LLM.
+        Call it after output_schema is built: models without the schema may
+        also return null or lists of strings.
+        
+        Args:
+            attributes: Attribute names Yang should return
+            
+        Returns:
+            Compiled validator raising fastjsonschema.JsonSchemaValueException, or
+            None if there are no planned attributes
+        """
+        if not attributes:
+            return None
+        
+        value_schema = {"type": ["string", "number", "boolean"]}
+        if self.output_schema is None:
+            # Without the strict schema models often answer null, or a list (of
+            # evidence links, say); leave those for the judge rather than rejecting them
+            value_schema = {"type": ["string", "number", "boolean", "null", "array"], "items": {"type": "string"}}
+        
+        return fastjsonschema.compile({
+            "type": "object",
+            "required": attributes,
+            "properties": {name: value_schema for name in attributes},
+        })
+    
     def build_row_context(self, row_data: Dict[str, Any]) -> Dict[str, Any]:
         """
         Build context for a specific row, possibly integrating external API data.
@@ -115,42 +302,98 @@ class YinAgent:
         Returns:
             Task dictionary for Yang
         """
-        # Prepare the system message that explains Yang's role
-        system_message = {
-            "role": "system",
-            "content": (
-                "You are Yang, an AI assistant specialized in data enrichment. "
-                "Your task is to analyze data and provide enrichment attributes. "
-                "You should return ONLY a JSON object with your enrichment results. "
-                "Each key in the JSON object should be an attribute, and each value should be the enrichment value in string data type."
-                "Only include your explanations and evidence weblink in evidence field when requested, to keep other fields clean "
-            )
-        }
+        # The system message holding Yang's role and the command is shared by every task
+        system_message = self.yang_system_message
         
         # Prepare the user message that contains the task for Yang
-        row_description = json.dumps(context["row_data"], indent=2)
+        # The text shared by every row comes first and the row itself last, so
+        # consecutive requests share the longest possible prompt prefix
+        row_description = _dump_row(context["row_data"])
         # api_info = json.dumps(context["api_results"], indent=2) if context["api_results"] else "No API results available" # TODO: add api when available
         
         user_message = {
             "role": "user",
             "content": (
-                f"I need you to enrich the following data row:\n\n"
-                f"DATA ROW:\n{row_description}\n\n"
-                #f"API INFORMATION:\n{api_info}\n\n"
-                f"ENRICHMENT TASK:\n{self.user_command}\n\n"
                 f"Return ONLY a JSON object with the enriched attributes as key-value pairs. "
-                f"Include your explanations and evidence weblink in evidence field when requested"
+                f"Include your explanations and evidence weblink in evidence field when requested\n\n"
+                #f"API INFORMATION:\n{api_info}\n\n"
+                f"I need you to enrich the following data row:\n\n"
+                f"DATA ROW:\n{row_description}"
             )
         }
         
         task = {
             "messages": [system_message, user_message],
-            "context": context
+            "context": context,
+            # What the semantic cache compares between tasks: only the row, not the instructions
+            "semantic_text": row_description,
         }
         
+        # Ask for structured output so the response is guaranteed to parse
+        if self.output_schema:
+            task["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "enrichment", "schema": self.output_schema, "strict": True},
+            }
+        
         return task
     
-    def validate_yang_response(self, yang_response: Dict[str, Any], context: Dict[str, Any]) -> Tuple[bool, str]:
+    def formulate_yang_batch_task(self, contexts: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Formulate a single Yang task that enriches several rows at once.
+        
+        Yang is asked for {"results": [...]} holding one enrichment object per
+        row, in the same order as the rows.
+        
+        Args:
+            contexts: The context dictionaries of the rows in the batch
+            
+        Returns:
+            Task dictionary for Yang
+        """
+        # Shared text first, rows last, as in formulate_yang_task
+        rows_description = _dump_row([context["row_data"] for context in contexts])
+        
+        user_message = {
+            "role": "user",
+            "content": (
+                f'Return ONLY a JSON object of the form {{"results": [...]}} with one object per data row, '
+                f"in the same order, each with the enriched attributes of that row as key-value pairs. "
+                f"Include your explanations and evidence weblink in evidence field when requested\n\n"
+                f'I need you to enrich each of the following data rows; "results" must hold exactly '
+                f"{len(contexts)} objects:\n\n"
+                f"DATA ROWS:\n{rows_description}"
+            )
+        }
+        
+        task = {
+            "messages": [self.yang_system_message, user_message],
+            "contexts": contexts,
+            "max_tokens": min(
+                max(YANG_MIN_TOKENS, YANG_TOKENS_PER_ROW * len(contexts)),
+                MAX_OUTPUT_TOKENS.get(self.model_name, DEFAULT_MAX_OUTPUT_TOKENS),
+            ),
+        }
+        
+        # Ask for structured output so the response is guaranteed to parse
+        if self.output_schema:
+            task["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "enrichment_batch",
+                    "schema": {
+                        "type": "object",
+                        "properties": {"results": {"type": "array", "items": self.output_schema}},
+                        "required": ["results"],
+                        "additionalProperties": False,
+                    },
+                    "strict": True,
+                },
+            }
+        
+        return task
+    
+    async def validate_yang_response(self, yang_response: Dict[str, Any], context: Dict[str, Any]) -> Tuple[bool, str]:
         """
         Validate Yang's response using the LLM's judgment.
         
@@ -160,6 +403,10 @@ class YinAgent:
             
         Returns:
             Tuple of (is_valid, validation_message)
+            
+        Raises:
+            NonRetriableError: If the API rejects the validation request in a way
+                retrying cannot fix
         """
         try:
             # Check if the response is a valid JSON object
@@ -170,6 +417,21 @@ class YinAgent:
             if not yang_response:
                 return False, "Response is empty"
             
+            # Yang reports failures as {"error": ...}; there is nothing to judge
+            if set(yang_response) == {"error"}:
+                return False, f"Yang reported an error: {yang_response['error']}"
+            
+            # Reject responses whose values are all blank
+            if all(value is None or (isinstance(value, str) and not value.strip()) for value in yang_response.values()):
+                return False, "All enrichment values are empty"
+            
+            # Check the planned attributes are present before spending an LLM call
+            if self._check_structure:
+                try:
+                    self._check_structure(yang_response)
+                except fastjsonschema.JsonSchemaValueException as e:
+                    return False, f"Response does not match the planned attributes: {e.message}"
+            
             # For more complex validation, we can use the LLM itself to validate the response
             system_message = {
                 "role": "system",
@@ -180,45 +442,64 @@ class YinAgent:
                 )
             }
             
-            row_description = json.dumps(context["row_data"], indent=2)
-            enrichment_result = json.dumps(yang_response, indent=2)
+            row_description = _dump_row(context["row_data"])
+            enrichment_result = _dump_row(yang_response)
             
+            # Shared instructions first, the row and result last
             user_message = {
                 "role": "user",
                 "content": (
+                    f"ENRICHMENT TASK:\n{self.user_command}\n\n"
+                    f"Is the enrichment result below reasonable and likely accurate with mid-low level of confidence? "
+                    f"If yes, respond with 'WOOHOO', if not, respond with 'NAYNAY'. followed by your reasoning.\n\n"
                     f"Please validate the following enrichment result:\n\n"
                     f"ORIGINAL DATA ROW:\n{row_description}\n\n"
-                    f"ENRICHMENT TASK:\n{self.user_command}\n\n"
-                    f"ENRICHMENT RESULT:\n{enrichment_result}\n\n"
-                    f"Is this enrichment result looks reasonable and likely accurate with mid-low level of confidence? "
-                    f"If yes, respond with 'WOOHOO', if not, respond with 'NAYNAY'. followed by your reasoning."
+                    f"ENRICHMENT RESULT:\n{enrichment_result}"
                 )
             }
             
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                # tools=[
-                #     {
-                #     "type": "web_search_preview",
-                #     "user_location": {
-                #         "type": "approximate",
-                #         "country": "US"
-                #     },
-                #     "search_context_size": "low"
-                #     }
-                # ],
-                messages=[system_message, user_message],
-                max_tokens=1000,
-                # temperature=0.3,
-            )
-            
-            validation_response = response.choices[0].message.content
+            # Stream the verdict so the request can be abandoned once it has been seen
+            async for attempt in transient_retry():
+                with attempt:
+                    validation_response = ""
+                    async with self._request_slot():
+                        stream = await self.client.chat.completions.create(
+                            model=self.model_name,
+                            # tools=[
+                            #     {
+                            #     "type": "web_search_preview",
+                            #     "user_location": {
+                            #         "type": "approximate",
+                            #         "country": "US"
+                            #     },
+                            #     "search_context_size": "low"
+                            #     }
+                            # ],
+                            messages=[system_message, user_message],
+                            max_tokens=1000,
+                            stream=True,
+                            # temperature=0.3,
+                        )
+                        try:
+                            async for chunk in stream:
+                                if chunk.choices and chunk.choices[0].delta.content:
+                                    validation_response += chunk.choices[0].delta.content
+                                    if not self.validation_reasoning and VERDICT_PATTERN.search(validation_response):
+                                        break
+                        finally:
+                            # Closing the response drops the connection and stops generation
+                            # (AsyncStream itself has no close() in the pinned openai)
+                            await stream.response.aclose()
             
-            # Check if the validation response indicates the enrichment is valid
-            is_valid = "WOOHOO" in validation_response.upper()
+            # The first verdict in the response decides whether the enrichment is valid
+            verdict = VERDICT_PATTERN.search(validation_response)
+            is_valid = verdict is not None and verdict.group().upper() != "NAYNAY"
             
             return is_valid, validation_response
         
+        except NON_RETRIABLE_ERRORS as e:
+            self.logger.error(f"Validation request rejected by the API: {str(e)}")
+            raise NonRetriableError(str(e)) from e
         except Exception as e:
             self.logger.error(f"Error during validation: {str(e)}")
             return False, f"Validation error: {str(e)}"
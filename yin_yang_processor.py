@@ -1,11 +1,41 @@
 import pandas as pd
 
-import json
-from typing import Callable, Dict, List, Any, Optional
+import asyncio
+import csv
+import os
+from typing import AsyncIterator, Callable, Dict, List, Any, Optional, Tuple
+
+import orjson
+import xxhash
 
 from yin import YinAgent
-from yang import YangAgent
-from utils import get_logger
+from yang import SemanticCache, YangAgent
+from utils import NonRetriableError, create_async_client, get_logger
+
+# Location of the persisted cache of validated row enrichments
+ROW_CACHE_PATH = os.path.join("logs", "row_cache.parquet")
+
+# uvloop is a faster drop-in event loop; it is not available on Windows
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+def _run(coro):
+    """Run a coroutine to completion on a fresh event loop, using uvloop when installed."""
+    if uvloop is not None:
+        return uvloop.run(coro)
+    return asyncio.run(coro)
+
+def _csv_value(value: Any) -> Any:
+    """Format a cell for csv.writer the way DataFrame.to_csv would, writing missing values as empty."""
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return ""
+    return value
+
+def _is_truncated(response: Any) -> bool:
+    """Whether Yang's response was cut off at the token limit."""
+    return isinstance(response, dict) and response.get("finish_reason") == "length"
 
 class YinYangProcessor:
     """
@@ -20,6 +50,12 @@ class YinYangProcessor:
         log_callback: Optional[Callable] = None,
         progress_callback: Optional[Callable] = None,
         output_file: Optional[str] = None,
+        max_concurrency: int = 8,
+        requests_per_minute: int = 500,
+        semantic_cache_threshold: Optional[float] = None,
+        batch_size: int = 20,
+        validation_reasoning: bool = False,
+        group_by_input_columns: bool = False,
     ):
         """
         Initialize the Yin-Yang processor.
@@ -30,21 +66,48 @@ class YinYangProcessor:
             log_callback: Callback function for logging messages
             progress_callback: Callback function for updating progress
             output_file: Path to output file for streaming results (optional)
+            max_concurrency: Maximum number of batches processed concurrently
+            requests_per_minute: Maximum number of Yang requests sent per minute
+            semantic_cache_threshold: Similarity above which Yang reuses a cached result
+                for a near-duplicate row (None disables the semantic cache)
+            batch_size: Number of rows packed into each Yang request
+            validation_reasoning: Whether Yin reads the validator's full reasoning instead
+                of stopping at the verdict
+            group_by_input_columns: Whether rows that agree on the input columns Yin plans
+                for the command share one enrichment, rather than only identical rows
         """
         self.model_name = model_name
         self.max_retries = max_retries
         self.log_callback = log_callback
         self.progress_callback = progress_callback
         self.output_file = output_file
+        self.max_concurrency = max_concurrency
+        self.batch_size = max(1, batch_size)
+        self.group_by_input_columns = group_by_input_columns
         self.logger = get_logger("YinYangProcessor")
         
         # Initialize agents
-        self.yin = YinAgent(model_name)
-        self.yang = YangAgent(model_name)
+        self.yang = YangAgent(
+            model_name,
+            rpm=requests_per_minute,
+            concurrency=max_concurrency,
+            semantic_threshold=semantic_cache_threshold,
+        )
+        # Validated enrichments of earlier rows, keyed on the model, Yang's prompt and row values
+        self.row_cache = SemanticCache(ROW_CACHE_PATH)
+        self.row_cache.load()
+        
+        # Yin's planning and validation requests share Yang's rate limits
+        self.yin = YinAgent(
+            model_name,
+            request_slot=self.yang.request_slot,
+            validation_reasoning=validation_reasoning,
+        )
     
     def log(self, message_type: str, content: str):
         """Log a message using the callback if available."""
-        self.logger.info(f"{message_type}: {content}")
+        # Formatting is deferred to the log listener thread
+        self.logger.info("%s: %s", message_type, content)
         if self.log_callback:
             self.log_callback(message_type, content)
     
@@ -57,6 +120,10 @@ class YinYangProcessor:
         """
         Process the data frame row by row using the Yin-Yang architecture.
         
+        Rows are packed into batches of ``batch_size`` per Yang request, and
+        batches are dispatched concurrently, with at most ``max_concurrency``
+        batches in flight at any time.
+        
         Args:
             df: Input data frame
             user_command: Natural language command from the user
@@ -64,12 +131,166 @@ class YinYangProcessor:
         Returns:
             Enriched data frame
         """
-        # Create a copy of the input data frame to avoid modifying the original
-        result_df = df.copy()
+        return _run(self.process_data_async(df, user_command))
+    
+    async def process_data_async(self, df: pd.DataFrame, user_command: str) -> pd.DataFrame:
+        """
+        Coroutine form of process_data, for callers that already run an event loop.
+        
+        Independent runs, each on its own processor, can be awaited concurrently
+        on one loop; each run opens its own connection pool and closes it when
+        the run ends.
+        A single processor should only run one command at a time, since Yin
+        keeps the command it was initialized with.
+        
+        Args:
+            df: Input data frame
+            user_command: Natural language command from the user
+            
+        Returns:
+            Enriched data frame
+        """
+        # Set up streaming output if an output file is specified; the file stays
+        # open for the whole run and the header is written once the enrichment
+        # columns are known
+        output = None
+        writer = None
+        unwritten = []  # Rows finished before the header could be written
+        if self.output_file:
+            self.log("system", f"Streaming results to {self.output_file}")
+            output = open(self.output_file, "w", newline="", encoding="utf-8")
+            source_rows = dict(zip(df.index, df.itertuples(index=False, name=None)))
+        
+        def write_rows(indices):
+            for index in indices:
+                row = dict(zip(df.columns, map(_csv_value, source_rows[index])))
+                row.update(enrichments[index])
+                writer.writerow(row)
+                self.log("system", f"Row {index + 1} written to output file")
+            output.flush()
+        
+        def enriched_keys(indices):
+            return [*self.yin.output_attributes, *(key for index in indices for key in enrichments[index])]
+        
+        # Enrichments are buffered and joined to the data once at the end,
+        # rather than assigned cell by cell as rows finish
+        enrichments: Dict[Any, Dict[str, str]] = {}
+        try:
+            async for index, enrichment in self.process_data_stream(df, user_command):
+                # Convert all values to string for consistency, with ai_decision first
+                enrichments[index] = {
+                    "ai_decision": str(enrichment.get("ai_decision", "")),
+                    **{key: str(value) for key, value in enrichment.items() if key != "ai_decision"},
+                }
+                
+                # Stream the processed row to the output file if specified
+                if not output:
+                    continue
+                if writer is not None:
+                    write_rows([index])
+                    continue
+                
+                # The columns are the attributes Yin planned plus the keys Yang actually
+                # returned up to the first accepted row; rows finished before then are held back
+                unwritten.append(index)
+                if enrichments[index]["ai_decision"] in ("valid", "cached"):
+                    writer = self._start_csv(output, df, enriched_keys(unwritten))
+                    write_rows(unwritten)
+                    unwritten = []
+        finally:
+            if output:
+                if writer is None:
+                    writer = self._start_csv(output, df, enriched_keys(unwritten))
+                    write_rows(unwritten)
+                output.close()
+        
+        # The enrichment values are all strings, which Arrow stores far more compactly than object columns
+        enrich_df = pd.DataFrame.from_dict(enrichments, orient="index").reindex(df.index)
+        if "ai_decision" not in enrich_df:
+            enrich_df["ai_decision"] = ""
+        enrich_df = enrich_df.astype("string[pyarrow]")
+        enrich_df["ai_decision"] = enrich_df["ai_decision"].fillna("")
+        
+        if df.columns.intersection(enrich_df.columns).empty:
+            # Attach the new columns without copying the input data
+            result_df = pd.concat([df, enrich_df], axis=1, copy=False)
+        else:
+            # assign keeps existing columns in place (overwriting them) and appends new ones
+            result_df = df.assign(**{column: enrich_df[column] for column in enrich_df.columns})
+        
+        # The streamed file holds rows in completion order, and may lack keys a later
+        # row brought; replace it with the result so it matches the returned frame
+        if self.output_file:
+            self._rewrite_output(result_df)
+        
+        self.log("system", f"Processing complete. Enriched {len(df)} rows.")
+        return result_df
+    
+    def _start_csv(self, output, df: pd.DataFrame, attributes: List[str]) -> csv.DictWriter:
+        """
+        Write the output file's header and return a writer for its rows.
         
-        # Add an ai_decision column to track validation status of each row
-        result_df["ai_decision"] = ""
+        Args:
+            output: Open text file to write to
+            df: Input data frame, whose columns come first
+            attributes: Enrichment attributes, written after ai_decision
+            
+        Returns:
+            DictWriter that ignores keys outside the header; the finished run
+            rewrites the file with every column
+        """
+        fieldnames = list(dict.fromkeys([*df.columns, "ai_decision", *attributes]))
+        writer = csv.DictWriter(output, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        return writer
+    
+    def _rewrite_output(self, result_df: pd.DataFrame):
+        """
+        Replace the streamed output file with the finished result, in input order.
+        
+        The file is written next to the original and then moved over it, so
+        readers see either the streamed rows or the complete result.
+        
+        Args:
+            result_df: Enriched data frame returned by the run
+        """
+        temp_path = f"{self.output_file}.tmp"
+        try:
+            result_df.to_csv(temp_path, index=False)
+            os.replace(temp_path, self.output_file)
+            self.log("system", f"Wrote {len(result_df)} rows to {self.output_file} in input order")
+        except OSError as e:
+            self.log("error", f"Error rewriting output file: {str(e)}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    
+    async def process_data_stream(self, df: pd.DataFrame, user_command: str) -> AsyncIterator[Tuple[Any, Dict[str, Any]]]:
+        """
+        Enrich the data frame, yielding each row as soon as it is finished.
+        
+        Rows finish in completion order rather than index order, so callers
+        can consume results without holding the whole enriched frame.
         
+        Args:
+            df: Input data frame
+            user_command: Natural language command from the user
+            
+        Yields:
+            Tuples of (index label, enrichment dictionary). The enrichment
+            dictionary holds the enriched attributes and the row's "ai_decision".
+        """
+        # Both agents share one connection pool for the run, closed when it ends
+        client = create_async_client()
+        self.yin.client = self.yang.client = client
+        try:
+            async for item in self._stream_rows(df, user_command):
+                yield item
+        finally:
+            self.yin.client = self.yang.client = None
+            await client.close()
+    
+    async def _stream_rows(self, df: pd.DataFrame, user_command: str) -> AsyncIterator[Tuple[Any, Dict[str, Any]]]:
+        """Generator behind process_data_stream, run with the agents' client in place."""
         # Log the start of processing
         total_rows = len(df)
         self.log("system", f"Starting to process {total_rows} rows")
@@ -77,109 +298,258 @@ class YinYangProcessor:
         
         # Initialize Yin with the user command
         self.log("system", "Initializing Yin agent with user command")
-        self.yin.initialize_with_command(user_command)
+        await self.yin.initialize_with_command(user_command, list(df.columns))
         
-        # Set up streaming output if an output file is specified
-        if self.output_file:
-            self.log("system", f"Streaming results to {self.output_file}")
-            # Create the file with headers
-            result_df.head(0).to_csv(self.output_file, index=False, mode='w')
+        # Pack rows into batches so each Yang request enriches several rows
+        # itertuples yields plain tuples, which are much cheaper than the Series built by iterrows
+        # Identical rows are enriched once and the result is fanned out to every copy;
+        # when grouping by input columns, rows only need to agree on those columns
+        columns = tuple(df.columns)
+        key_positions = list(range(len(columns)))
+        if self.group_by_input_columns and self.yin.input_columns:
+            self.log("yin", f"Grouping rows by input columns: {self.yin.input_columns}")
+            key_positions = [columns.index(name) for name in self.yin.input_columns]
+        rows = []
+        duplicates: Dict[Any, List[Any]] = {}
+        first_index: Dict[Tuple, Any] = {}
+        for index, values in zip(df.index, df.itertuples(index=False, name=None)):
+            # Missing values are normalized since NaN never compares equal to itself
+            key = tuple(None if pd.isna(values[i]) else values[i] for i in key_positions)
+            if key in first_index:
+                duplicates[first_index[key]].append(index)
+                continue
+            first_index[key] = index
+            duplicates[index] = [index]
+            rows.append((index, dict(zip(columns, values))))
         
-        # Process each row
-        for index, row in df.iterrows():
-            current_row = index + 1
-            self.update_progress(current_row)
-            
-            self.log("system", f"Processing row {current_row}/{total_rows}")
-            
-            # Convert row to a dictionary
-            row_dict = row.to_dict()
+        if len(rows) < total_rows:
+            self.log("system", f"Enriching {len(rows)} distinct rows ({total_rows - len(rows)} rows reuse their results)")
+        batches = [rows[i:i + self.batch_size] for i in range(0, len(rows), self.batch_size)]
+        
+        # Finished rows are handed from the batch tasks to this generator through a queue
+        finished_rows = asyncio.Queue()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        async def run_batch(batch):
+            emitted = set()
             
-            # Initialize retry counter and state tracking
-            retry_count = 0
-            success = False
-            had_error = False  # To track if any errors occurred during processing
+            def emit(index, enrichment):
+                emitted.add(index)
+                for duplicate in duplicates[index]:
+                    finished_rows.put_nowait((duplicate, dict(enrichment)))
             
-            while not success and retry_count < self.max_retries:
+            async with semaphore:
                 try:
-                    if retry_count > 0:
-                        self.log("system", f"Retry {retry_count}/{self.max_retries} for row {current_row}")
-                    
-                    # Step 1: Yin analyzes the row and creates a context
-                    self.log("yin", f"Analyzing row {current_row} and building context")
-                    yin_context = self.yin.build_row_context(row_dict)
-                    
-                    # Step 2: Yin formulates a task for Yang
-                    self.log("yin", "Formulating task for Yang")
-                    yang_task = self.yin.formulate_yang_task(yin_context)
-                    
-                    # Step 3: Yang processes the task
-                    self.log("yang", "Processing task")
-                    yang_result = self.yang.process_task(yang_task)
-                    
-                    # Log Yang's response (in a simplified form)
-                    self.log("yang", f"Generated enrichment data: {json.dumps(yang_result, indent=2)}")
-                    
-                    # Step 4: Yin validates Yang's result
-                    self.log("yin", "Validating Yang's response")
-                    validation_result, validation_message = self.yin.validate_yang_response(yang_result, yin_context)
-                    
-                    # Add new columns to the result dataframe regardless of validation outcome
-                    # This ensures enriched fields are added even for invalid results
-                    for key, value in yang_result.items():
-                        result_df.loc[index, key] = str(value)  # Convert all values to string for consistency
-                    
-                    if validation_result:
-                        # If valid, update ai_decision status
-                        self.log("yin", f"Validation successful: {validation_message}")
-                        
-                        # Mark this row as valid
-                        result_df.loc[index, "ai_decision"] = "valid"
-                        
-                        # Set success flag and immediately break out of the retry loop
-                        success = True
-                        break  # Skip any remaining retries since we have a valid result
-                    else:
-                        # If invalid, log the reason and retry
-                        self.log("yin", f"Validation failed: {validation_message}")
-                        
-                        # Mark this attempt as invalid in ai_decision
-                        # May be overwritten by future successful attempts
-                        result_df.loc[index, "ai_decision"] = "invalid"
-                        
-                        retry_count += 1
-                        
-                        # If this is the last retry, log that all attempts failed
-                        if retry_count >= self.max_retries:
-                            self.log("yin", f"All validation attempts failed for row {current_row}")
-                
+                    await self._process_batch(batch, total_rows, emit)
                 except Exception as e:
-                    error_message = str(e)
-                    self.log("error", f"Error processing row {current_row}: {error_message}")
-                    had_error = True
-                    retry_count += 1
-                    
-                    # If this is the last retry, prepare to mark as error
-                    if retry_count >= self.max_retries:
-                        self.log("error", f"All processing attempts failed with errors for row {current_row}")
+                    # Never leave rows unreported, or the generator would wait forever
+                    self.log("error", f"Unexpected error processing batch: {str(e)}")
+                    for index, _ in batch:
+                        if index not in emitted:
+                            emit(index, {"ai_decision": "error"})
+        
+        # Schedule every batch first, then yield rows as they finish
+        tasks = [asyncio.create_task(run_batch(batch)) for batch in batches]
+        try:
+            for completed_rows in range(1, total_rows + 1):
+                yield await finished_rows.get()
+                self.update_progress(completed_rows)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        
+        # Keep Yang's response cache and the validated rows for the next run; saving
+        # merges with the files on disk, so it runs off the loop to not stall other runs
+        await asyncio.gather(
+            asyncio.to_thread(self.yang.save_cache),
+            asyncio.to_thread(self.row_cache.save),
+        )
+    
+    def _row_key(self, row_dict: Dict[str, Any]) -> int:
+        """Hash the model, Yang's system prompt and row values into a row cache key."""
+        # The system prompt holds the command and the planned attribute names, which
+        # come from an LLM call and can differ between runs of the same command
+        h = xxhash.xxh3_64(self.model_name.encode())
+        h.update(b"\0")
+        h.update(self.yin.yang_system_message["content"].encode())
+        h.update(b"\0")
+        h.update(orjson.dumps(
+            row_dict,
+            default=str,
+            option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        ))
+        return h.intdigest()
+    
+    async def _run_yang(self, contexts: List[Dict[str, Any]], use_cache: bool) -> List[Optional[Dict[str, Any]]]:
+        """
+        Have Yang enrich a batch of rows in a single request.
+        
+        If Yang returns the wrong number of results, or its response was cut
+        off at the token limit, the batch is bisected and each half is retried
+        until the counts match or single rows remain.
+        
+        Args:
+            contexts: Yin contexts of the rows to enrich
+            use_cache: Whether Yang may answer from its response cache
             
-            if not success:
-                # Detailed log message about the final status
-                if had_error:
-                    # If any error occurred during processing, mark as "error"
-                    result_df.loc[index, "ai_decision"] = "error"
-                    self.log("system", f"Row {current_row}: Final status 'error' - Processing exceptions prevented completion")
+        Returns:
+            One enrichment dictionary per context, or None where Yang returned no result
+        """
+        if len(contexts) == 1:
+            yang_task = self.yin.formulate_yang_task(contexts[0])
+            response = await self.yang.process_task_async(yang_task, use_cache=use_cache)
+            return [None if _is_truncated(response) else response]
+        
+        yang_task = self.yin.formulate_yang_batch_task(contexts)
+        response = await self.yang.process_task_async(yang_task, use_cache=use_cache)
+        
+        results = response.get("results") if isinstance(response, dict) else None
+        truncated = _is_truncated(response)
+        if not truncated and not isinstance(results, list):
+            raise ValueError(f"Batch response has no results list: {response}")
+        
+        # With the wrong number of results the rows cannot be matched up by
+        # position, and a truncated response cannot be trusted at all, so
+        # split the batch in half and enrich each half separately
+        if truncated or len(results) != len(contexts):
+            if truncated:
+                self.log("system", f"Batch response for {len(contexts)} rows was truncated, splitting it")
+            else:
+                self.log("system", f"Batch returned {len(results)} results for {len(contexts)} rows, splitting it")
+            middle = len(contexts) // 2
+            halves = await asyncio.gather(
+                self._run_yang(contexts[:middle], use_cache),
+                self._run_yang(contexts[middle:], use_cache),
+            )
+            return halves[0] + halves[1]
+        
+        # Rows without a usable result are reported as missing and retried
+        return [result if isinstance(result, dict) else None for result in results]
+    
+    async def _process_batch(
+        self,
+        batch: List[Tuple[Any, Dict[str, Any]]],
+        total_rows: int,
+        emit: Callable[[Any, Dict[str, Any]], None],
+    ):
+        """
+        Enrich a batch of rows, retrying the rows Yin does not accept.
+        
+        Each attempt sends the rows that are still pending to Yang in one
+        request, then validates every returned result on its own.
+        
+        Args:
+            batch: List of (index label, row dictionary) pairs
+            total_rows: Total number of rows, used for log messages
+            emit: Called with (index label, enrichment dictionary) once a row is finished
+        """
+        row_numbers = [index + 1 for index, _ in batch]
+        self.log("system", f"Processing rows {row_numbers[0]}-{row_numbers[-1]}/{total_rows}")
+        
+        # Step 1: Yin analyzes each row and creates a context
+        self.log("yin", f"Analyzing rows {row_numbers[0]}-{row_numbers[-1]} and building context")
+        contexts = {index: self.yin.build_row_context(row_dict) for index, row_dict in batch}
+        
+        # Initialize retry counter and state tracking
+        pending = [index for index, _ in batch]
+        enrichments = {index: {} for index in pending}
+        
+        # Rows enriched and validated in an earlier run are finished straight
+        # away, skipping both Yang and Yin's validation
+        row_keys = {index: self._row_key(row_dict) for index, row_dict in batch}
+        cached_rows = []
+        for index in pending:
+            cached = self.row_cache.get(row_keys[index])
+            if cached is not None:
+                cached_rows.append(index)
+                enrichments[index].update(cached)
+                emit(index, {**enrichments[index], "ai_decision": "cached"})
+        if cached_rows:
+            self.log("system", f"Reusing cached enrichments for rows {[index + 1 for index in cached_rows]}")
+            pending = [index for index in pending if index not in cached_rows]
+        had_error = set()  # Rows for which any errors occurred during processing
+        abandoned = []  # Rows given up on without using their remaining retries
+        retry_count = 0
+        
+        while pending and retry_count < self.max_retries:
+            if retry_count > 0:
+                self.log("system", f"Retry {retry_count}/{self.max_retries} for rows {[index + 1 for index in pending]}")
+            
+            try:
+                # Steps 2 and 3: Yin formulates one task for the pending rows and Yang processes it
+                # (retries bypass the cache to get a fresh answer)
+                self.log("yang", f"Processing task for {len(pending)} rows")
+                yang_results = await self._run_yang([contexts[index] for index in pending], use_cache=retry_count == 0)
+            except NonRetriableError as e:
+                # The API will reject these rows again, so do not spend the retries
+                self.log("error", f"Rows {[index + 1 for index in pending]} rejected by the API, not retrying: {str(e)}")
+                had_error.update(pending)
+                break
+            except Exception as e:
+                self.log("error", f"Error processing rows {[index + 1 for index in pending]}: {str(e)}")
+                had_error.update(pending)
+                retry_count += 1
+                continue
+            
+            # Step 4: Yin validates each of Yang's results concurrently
+            returned = [(index, result) for index, result in zip(pending, yang_results) if result is not None]
+            validations = await asyncio.gather(*[
+                self.yin.validate_yang_response(result, contexts[index])
+                for index, result in returned
+            ], return_exceptions=True)
+            
+            still_pending = [index for index, result in zip(pending, yang_results) if result is None]
+            for index in still_pending:
+                self.log("error", f"No result returned for row {index + 1}")
+                had_error.add(index)
+            
+            for (index, yang_result), validation in zip(returned, validations):
+                current_row = index + 1
+                
+                # Log Yang's response (in a simplified form, on one line)
+                self.log("yang", f"Generated enrichment data for row {current_row}: {orjson.dumps(yang_result, default=str).decode()}")
+                
+                # Keep the enriched fields regardless of validation outcome
+                # This ensures enriched fields are added even for invalid results
+                enrichments[index].update(yang_result)
+                
+                if isinstance(validation, NonRetriableError):
+                    self.log("error", f"Validation of row {current_row} rejected by the API, not retrying: {str(validation)}")
+                    had_error.add(index)
+                    abandoned.append(index)
+                    continue
+                
+                if isinstance(validation, Exception):
+                    self.log("error", f"Error validating row {current_row}: {str(validation)}")
+                    had_error.add(index)
+                    still_pending.append(index)
+                    continue
+                
+                validation_result, validation_message = validation
+                if validation_result:
+                    # If valid, mark this row as valid and finish it
+                    self.log("yin", f"Validation successful for row {current_row}: {validation_message}")
+                    self.row_cache.put(row_keys[index], yang_result)
+                    emit(index, {**enrichments[index], "ai_decision": "valid"})
                 else:
-                    # If we just couldn't get a valid result (validation failures), mark as "invalid"
-                    result_df.loc[index, "ai_decision"] = "invalid"
-                    self.log("system", f"Row {current_row}: Final status 'invalid' - Validation criteria not met after {self.max_retries} attempts")
+                    # If invalid, log the reason and retry
+                    # May be overwritten by future successful attempts
+                    self.log("yin", f"Validation failed for row {current_row}: {validation_message}")
+                    still_pending.append(index)
             
-            # Stream the processed row to the output file if specified
-            if self.output_file:
-                # Extract just the current row and append it to the output file
-                row_df = result_df.iloc[[index]]
-                row_df.to_csv(self.output_file, mode='a', header=False, index=False)
-                self.log("system", f"Row {current_row} written to output file")
-        
-        self.log("system", f"Processing complete. Enriched {total_rows} rows.")
-        return result_df
+            pending = still_pending
+            retry_count += 1
+        
+        for index in pending + abandoned:
+            current_row = index + 1
+            # Detailed log message about the final status
+            if index in had_error:
+                # If any error occurred during processing, mark as "error"
+                status = "error"
+                self.log("system", f"Row {current_row}: Final status 'error' - Processing exceptions prevented completion")
+            else:
+                # If we just couldn't get a valid result (validation failures), mark as "invalid"
+                status = "invalid"
+                self.log("system", f"Row {current_row}: Final status 'invalid' - Validation criteria not met after {self.max_retries} attempts")
+            emit(index, {**enrichments[index], "ai_decision": status})